@@ -1,77 +1,200 @@
 import os
 import re
+import time
+import random
+import functools
 import json
 import uuid
+import sqlite3
+import tempfile
 import threading
+from bisect import bisect_right
 from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime, timezone
+from operator import itemgetter
+import orjson
+import requests
 import spotipy
-from flask import Flask, redirect, render_template, request, session, jsonify
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+from flask import Flask, Response, redirect, render_template, request, session, jsonify
+from spotipy.cache_handler import CacheHandler
+from spotipy.exceptions import SpotifyException, SpotifyOauthError
 from spotipy.oauth2 import SpotifyOAuth
 SPOTIPY_CLIENT_ID = os.environ.get('SPOTIPY_CLIENT_ID')
 SPOTIPY_CLIENT_SECRET = os.environ.get('SPOTIPY_CLIENT_SECRET')
 REDIRECT_URI = os.environ.get('REDIRECT_URI')
 SECRET_KEY = os.environ.get('SECRET_KEY')
+REDIS_URL = os.environ.get('REDIS_URL')
+ENABLE_STATUS_STREAM = os.environ.get('ENABLE_STATUS_STREAM') == '1'
 SCOPE = "user-library-read playlist-modify-public playlist-modify-private"
 BLOCKLIST_KEYWORDS = ['trailer', 'bonus:', 'replay:', 'announcement', 'preview']
+_BLOCK_RE = re.compile('|'.join(map(re.escape, BLOCKLIST_KEYWORDS)), re.IGNORECASE)
+_ID_RE = re.compile(r'(playlist|show|episode)/([a-zA-Z0-9]+)')
+_BARE_ID_RE = re.compile(r'^[a-zA-Z0-9]+$')
+SCAN_WORKERS = 10
+EPISODE_PAGE_SIZE = 50
+EPISODE_BATCH_SIZE = 50
+TARGET_QUEUE_SIZE = 50
+RETRY_ATTEMPTS = 5
+RETRY_STATUSES = {429, 500, 502, 503, 504}
 STATE_FOLDER = os.path.join(os.path.expanduser('~'), 'user_states')
 if not os.path.exists(STATE_FOLDER):
     os.makedirs(STATE_FOLDER)
 app = Flask(__name__)
 app.config['SECRET_KEY'] = SECRET_KEY
 TOKEN_INFO_KEY = 'spotify_token_info'
+_AUTH_MANAGERS = {}
+JOB_STATUS_TTL = 3600
+JOB_TIMEOUT = 1800
+STATUS_STREAM_TIMEOUT = 15
+STATUS_STREAM_MAX_AGE = 60
+STATUS_STREAM_RETRY_MS = 1000
 background_jobs = {}
+job_status_changed = threading.Condition()
+redis_client = None
+task_queue = None
+if REDIS_URL:
+    import redis
+    from flask_session import Session
+    from rq import Queue
+    redis_client = redis.Redis.from_url(REDIS_URL)
+    task_queue = Queue(connection=redis_client)
+    app.config['SESSION_TYPE'] = 'redis'
+    app.config['SESSION_REDIS'] = redis_client
+    Session(app)
+class SharedSession(requests.Session):
+    """Session shared by every Spotify client; Spotipy closes its session when a client is collected."""
+    def close(self):
+        pass
+def _build_http_session():
+    """Builds one pooled HTTP session, retrying only failed connections, shared by all Spotify clients."""
+    http_session = SharedSession()
+    retry = Retry(
+        total=spotipy.Spotify.max_retries, connect=spotipy.Spotify.max_retries, read=False, status=0,
+        allowed_methods=frozenset(['GET', 'POST', 'PUT', 'DELETE']), backoff_factor=0.3,
+        respect_retry_after_header=False
+    )
+    adapter = HTTPAdapter(pool_maxsize=SCAN_WORKERS, max_retries=retry)
+    http_session.mount('https://', adapter)
+    return http_session
+http_session = _build_http_session()
+def retry_with_backoff(max_attempts=RETRY_ATTEMPTS, base_delay=1, max_delay=60, retry_statuses=RETRY_STATUSES):
+    """Retries Spotify calls on rate limiting or server errors, honouring Retry-After up to max_delay."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            for attempt in range(1, max_attempts + 1):
+                try:
+                    return func(*args, **kwargs)
+                except SpotifyException as e:
+                    if e.http_status not in retry_statuses or attempt == max_attempts: raise
+                    retry_after = (e.headers or {}).get('Retry-After', '')
+                    if retry_after.isdigit():
+                        delay = int(retry_after)
+                        if delay > max_delay:
+                            raise SpotifyException(
+                                e.http_status, e.code,
+                                f"Spotify is rate limiting requests; please try again in {delay // 60 + 1} minutes.",
+                                headers=e.headers
+                            ) from e
+                    else:
+                        delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+                    app.logger.warning(f"Spotify returned {e.http_status}, retrying in {delay:.1f}s ({attempt}/{max_attempts})")
+                    time.sleep(delay)
+        return wrapper
+    return decorator
+class RetryingSpotify(spotipy.Spotify):
+    """Spotipy client whose API requests go through retry_with_backoff; POSTs only retry on 429."""
+    def _internal_call(self, method, url, payload, params):
+        retry_statuses = {429} if method == 'POST' else RETRY_STATUSES
+        call = retry_with_backoff(retry_statuses=retry_statuses)(super()._internal_call)
+        return call(method, url, payload, params)
+class TokenFileCacheHandler(CacheHandler):
+    """Reads and atomically writes a user's token file for Spotipy."""
+    def __init__(self, user_id):
+        self.user_id = user_id
+    def get_cached_token(self):
+        try:
+            with open(_get_token_path(self.user_id), 'rb') as f: return orjson.loads(f.read())
+        except (IOError, orjson.JSONDecodeError): return None
+    def save_token_to_cache(self, token_info):
+        _save_token(self.user_id, token_info)
+class ServerSpotifyOAuth(SpotifyOAuth):
+    """SpotifyOAuth shared across threads: token reads and refreshes are serialized, and it never prompts."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._token_lock = threading.Lock()
+    def get_access_token(self, *args, **kwargs):
+        with self._token_lock:
+            return super().get_access_token(*args, **kwargs)
+    def get_auth_response(self, open_browser=None):
+        raise SpotifyOauthError("No valid Spotify token is saved for this user; please log in again.")
+def _get_auth_manager(user_id):
+    """Returns the user's SpotifyOAuth, creating it on first use; it refreshes the token file itself."""
+    auth_manager = _AUTH_MANAGERS.get(user_id)
+    if auth_manager is None:
+        auth_manager = _AUTH_MANAGERS[user_id] = ServerSpotifyOAuth(
+            client_id=SPOTIPY_CLIENT_ID, client_secret=SPOTIPY_CLIENT_SECRET,
+            redirect_uri=REDIRECT_URI, scope=SCOPE, cache_handler=TokenFileCacheHandler(user_id)
+        )
+    return auth_manager
 def get_spotify_client_for_thread(user_id):
     """Creates a Spotipy client from a user's saved token file, handling refreshes."""
     token_path = _get_token_path(user_id)
-    token_info = _load_token(user_id)
-    if not token_info:
+    if not os.path.exists(token_path):
         raise Exception(f"Token for user {user_id} not found in {token_path}.")
-    auth_manager = SpotifyOAuth(
-        client_id=SPOTIPY_CLIENT_ID, client_secret=SPOTIPY_CLIENT_SECRET,
-        redirect_uri=REDIRECT_URI, scope=SCOPE, cache_path=token_path
-    )
-    auth_manager.validate_token(token_info)
-    return spotipy.Spotify(auth_manager=auth_manager)
+    return RetryingSpotify(auth_manager=_get_auth_manager(user_id), requests_session=http_session)
 def get_spotify_client():
-    """Creates a Spotipy client from the user's session token."""
-    token_info = session.get(TOKEN_INFO_KEY)
-    if not token_info:
+    """Creates a Spotipy client for the logged-in user of the current session."""
+    user_id = session.get('user_id')
+    if not session.get(TOKEN_INFO_KEY) or not user_id:
         return None
-    if SpotifyOAuth.is_token_expired(token_info):
-        user_id = session.get('user_id')
-        token_path = _get_token_path(user_id)
-        auth_manager = SpotifyOAuth(
-            client_id=SPOTIPY_CLIENT_ID, client_secret=SPOTIPY_CLIENT_SECRET,
-            redirect_uri=REDIRECT_URI, scope=SCOPE, cache_path=token_path
-        )
-        token_info = auth_manager.refresh_access_token(token_info['refresh_token'])
-        _save_token(user_id, token_info)
-        session[TOKEN_INFO_KEY] = token_info
-    return spotipy.Spotify(auth=token_info['access_token'])
+    if not os.path.exists(_get_token_path(user_id)):
+        return None
+    return RetryingSpotify(auth_manager=_get_auth_manager(user_id), requests_session=http_session)
+def _write_json_atomic(path, data, option=None):
+    """Writes JSON to a unique temporary file and renames it over the target."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f: f.write(orjson.dumps(data, option=option))
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+        raise
 def _get_user_state_path(user_id):
     return os.path.join(STATE_FOLDER, f"{user_id}.json")
 def _load_state(user_id):
     state_file = _get_user_state_path(user_id)
     if not os.path.exists(state_file): return {}
     try:
-        with open(state_file, 'r') as f: return json.load(f)
-    except (json.JSONDecodeError, IOError): return {}
+        with open(state_file, 'rb') as f: return orjson.loads(f.read())
+    except (orjson.JSONDecodeError, IOError): return {}
 def _save_state(user_id, state):
-    state_file = _get_user_state_path(user_id)
-    with open(state_file, 'w') as f: json.dump(state, f, indent=4)
+    _write_json_atomic(_get_user_state_path(user_id), state, option=orjson.OPT_INDENT_2)
 def _get_token_path(user_id):
     return os.path.join(STATE_FOLDER, f"{user_id}_token.json")
-def _load_token(user_id):
-    try:
-        with open(_get_token_path(user_id), 'r') as f: return json.load(f)
-    except (IOError, json.JSONDecodeError): return None
 def _save_token(user_id, token_info):
-    with open(_get_token_path(user_id), 'w') as f: json.dump(token_info, f)
+    _write_json_atomic(_get_token_path(user_id), token_info)
+def _get_episode_db_path(user_id):
+    return os.path.join(STATE_FOLDER, f"{user_id}.db")
+def _open_episode_db(user_id):
+    """Opens the user's SQLite store of per-show scan progress and cached unplayed episodes."""
+    db = sqlite3.connect(_get_episode_db_path(user_id))
+    db.row_factory = sqlite3.Row
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("CREATE TABLE IF NOT EXISTS show_progress (show_id TEXT PRIMARY KEY, last_episode_id TEXT NOT NULL)")
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS episodes (id TEXT PRIMARY KEY, show_id TEXT NOT NULL, uri TEXT NOT NULL,"
+        " name TEXT NOT NULL, duration_ms INTEGER NOT NULL, release_date TEXT NOT NULL)"
+    )
+    db.execute("CREATE INDEX IF NOT EXISTS episodes_show_id ON episodes (show_id)")
+    return db
 def extract_item_id(text):
-    match = re.search(r'(playlist|show|episode)/([a-zA-Z0-9]+)', text)
+    match = _ID_RE.search(text)
     if match: return match.group(2)
-    if re.match(r'^[a-zA-Z0-9]+$', text.strip()): return text.strip()
+    if _BARE_ID_RE.match(text.strip()): return text.strip()
     return None
 def run_update_task(user_id, playlist_id):
     """The main background task orchestrator."""
@@ -85,15 +208,32 @@ def run_update_task(user_id, playlist_id):
         if not saved_shows:
             _update_job_status(user_id, "No saved shows found.", 1, 1, is_done=True)
             return
-        priority_eps, backlog_eps = _scan_all_shows(sp, user_id, saved_shows, last_update_dt)
-        last_minute = state.get('current_minute', -1)
-        next_batch, next_minute = _determine_next_backlog_batch(backlog_eps, last_minute, min_duration)
-        uris_to_add = [ep['uri'] for ep in sorted(priority_eps, key=lambda x: x['duration_ms'])]
+        db = _open_episode_db(user_id)
+        try:
+            priority_eps, fresh_ids = _scan_all_shows(sp, user_id, saved_shows, last_update_dt, db)
+            _update_job_status(user_id, "Checking backlog for played episodes...", len(saved_shows), len(saved_shows))
+            priority_eps = _drop_played_episodes(sp, db, priority_eps, fresh_ids)
+            next_minute = state.get('current_minute', -1)
+            next_batch = []
+            if len(priority_eps) < TARGET_QUEUE_SIZE:
+                backlog_by_minute = _load_backlog_by_minute(db, last_update_dt)
+                last_minute = next_minute
+                while True:
+                    next_batch, next_minute = _determine_next_backlog_batch(backlog_by_minute, last_minute, min_duration)
+                    unplayed_batch = _drop_played_episodes(sp, db, next_batch, fresh_ids)
+                    if unplayed_batch or not next_batch: break
+                    del backlog_by_minute[next_minute]
+                next_batch = unplayed_batch
+            db.commit()
+        finally:
+            db.close()
+        uris_to_add = [ep['uri'] for ep in sorted(priority_eps, key=itemgetter('duration_ms'))]
         uris_to_add.extend([ep['uri'] for ep in next_batch])
         _update_job_status(user_id, f"Updating playlist with {len(uris_to_add)} episodes...", len(saved_shows), len(saved_shows))
         if uris_to_add:
-            sp.playlist_replace_items(playlist_id, [])
-            for i in range(0, len(uris_to_add), 100):
+            sp.playlist_replace_items(playlist_id, uris_to_add[:100])
+            # Appends stay sequential: the playlist order is the queue order, and concurrent appends land in completion order.
+            for i in range(100, len(uris_to_add), 100):
                 sp.playlist_add_items(playlist_id, uris_to_add[i:i+100])
         state['current_minute'] = next_minute
         state['last_batch_info'] = {
@@ -115,55 +255,182 @@ def _fetch_all_shows(sp, user_id):
         saved_shows.extend(item['show'] for item in results['items'])
         results = sp.next(results) if results['next'] else None
     return saved_shows
-def _scan_all_shows(sp, user_id, shows, last_update_dt):
-    """Scans all episodes for all shows to build a complete list of unplayed episodes."""
-    priority_episodes = []
-    backlog_episodes = []
+def _reached_seen_episodes(items, last_seen_id, last_update_str):
+    """True once a page holds the last-seen episode or one released before the last update."""
+    return any(ep and (ep['id'] == last_seen_id or ep['release_date'][:10] < last_update_str) for ep in items)
+def _discover_new_episodes(sp, user_id, shows, show_progress, last_update_dt):
+    """Pages each show's episodes (newest first) down to its last-seen episode."""
     total_shows = len(shows)
-    for i, show in enumerate(shows):
-        _update_job_status(user_id, f"({i+1}/{total_shows}) Scanning: {show['name']}", i, total_shows)
-        ep_results = sp.show_episodes(show['id'], limit=50)
-        while ep_results:
-            for episode in ep_results['items']:
-                if not episode:
-                    continue
-                if episode.get('resume_point', {}).get('fully_played', False): continue
-                if any(keyword in episode['name'].lower() for keyword in BLOCKLIST_KEYWORDS): continue
-                release_date_str = episode['release_date']
-                release_dt = datetime.fromisoformat(release_date_str.replace('Z', '+00:00'))
-                if release_dt.tzinfo is None:
-                    release_dt = release_dt.replace(tzinfo=timezone.utc)
-                if release_dt > last_update_dt:
-                    priority_episodes.append(episode)
-                else:
-                    backlog_episodes.append(episode)
-            ep_results = sp.next(ep_results) if ep_results['next'] else None
-    return priority_episodes, backlog_episodes
-def _determine_next_backlog_batch(backlog_episodes, last_minute_processed, min_duration=0):
-    """Filters backlog by min_duration and finds the next batch to add."""
-    filtered_backlog = [
-        ep for ep in backlog_episodes
-        if (ep['duration_ms'] // 60000) >= min_duration
-    ]
-    if not filtered_backlog: return [], -1
+    scanned_shows = 0
+    last_update_str = last_update_dt.strftime('%Y-%m-%d')
+    pages = {show['id']: {} for show in shows}
+    with ThreadPoolExecutor(max_workers=SCAN_WORKERS) as executor:
+        pending = {executor.submit(sp.show_episodes, show['id'], limit=EPISODE_PAGE_SIZE): (show, 0) for show in shows}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                show, offset = pending.pop(future)
+                try:
+                    results = future.result()
+                except Exception:
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    raise
+                pages[show['id']][offset] = results['items']
+                if offset == 0:
+                    scanned_shows += 1
+                    _update_job_status(user_id, f"({scanned_shows}/{total_shows}) Scanning: {show['name']}", scanned_shows - 1, total_shows)
+                last_seen_id = show_progress.get(show['id'])
+                if last_seen_id is None:
+                    if offset == 0:
+                        for page_offset in range(EPISODE_PAGE_SIZE, results['total'], EPISODE_PAGE_SIZE):
+                            page = executor.submit(sp.show_episodes, show['id'], limit=EPISODE_PAGE_SIZE, offset=page_offset)
+                            pending[page] = (show, page_offset)
+                elif results['next'] and not _reached_seen_episodes(results['items'], last_seen_id, last_update_str):
+                    page_offset = offset + EPISODE_PAGE_SIZE
+                    pending[executor.submit(sp.show_episodes, show['id'], limit=EPISODE_PAGE_SIZE, offset=page_offset)] = (show, page_offset)
+    new_episodes = {}
+    for show in shows:
+        last_seen_id = show_progress.get(show['id'])
+        show_pages = pages[show['id']]
+        episodes = list({ep['id']: ep for offset in sorted(show_pages) for ep in show_pages[offset] if ep}.values())
+        episode_ids = [ep['id'] for ep in episodes]
+        cutoff = episode_ids.index(last_seen_id) if last_seen_id in episode_ids else len(episodes)
+        new_episodes[show['id']] = episodes[:cutoff]
+    return new_episodes
+def _hydrate_episodes(sp, episode_ids):
+    """Fetches full episode objects in batches via the bulk /episodes endpoint, plus the IDs Spotify no longer has."""
+    chunks = [episode_ids[i:i+EPISODE_BATCH_SIZE] for i in range(0, len(episode_ids), EPISODE_BATCH_SIZE)]
+    with ThreadPoolExecutor(max_workers=SCAN_WORKERS) as executor:
+        results = list(executor.map(sp.episodes, chunks))
+    episodes = []
+    missing_ids = []
+    for chunk, result in zip(chunks, results):
+        for episode_id, episode in zip(chunk, result['episodes']):
+            if episode: episodes.append(episode)
+            else: missing_ids.append(episode_id)
+    return episodes, missing_ids
+def _drop_played_episodes(sp, db, episodes, fresh_ids):
+    """Re-checks cached episodes, evicting finished or removed ones from the cache."""
+    stale_ids = [ep['id'] for ep in episodes if ep['id'] not in fresh_ids]
+    hydrated, missing_ids = _hydrate_episodes(sp, stale_ids)
+    evicted_ids = set(missing_ids)
+    for episode in hydrated:
+        fresh_ids.add(episode['id'])
+        if episode.get('resume_point', {}).get('fully_played', False):
+            evicted_ids.add(episode['id'])
+    db.executemany("DELETE FROM episodes WHERE id = ?", [(episode_id,) for episode_id in evicted_ids])
+    return [ep for ep in episodes if ep['id'] not in evicted_ids]
+def _scan_all_shows(sp, user_id, shows, last_update_dt, db):
+    """Adds newly released episodes to the episode cache and returns those released since the last update."""
+    fresh_ids = set()
+    show_progress = dict(db.execute("SELECT show_id, last_episode_id FROM show_progress").fetchall())
+    sp.auth_manager.get_access_token(as_dict=False)
+    new_episodes = _discover_new_episodes(sp, user_id, shows, show_progress, last_update_dt)
+    saved_show_ids = {show['id'] for show in shows}
+    cached_show_ids = {row['show_id'] for row in db.execute("SELECT DISTINCT show_id FROM episodes")}
+    unsaved_show_ids = [(show_id,) for show_id in (cached_show_ids | set(show_progress)) - saved_show_ids]
+    db.executemany("DELETE FROM episodes WHERE show_id = ?", unsaved_show_ids)
+    db.executemany("DELETE FROM show_progress WHERE show_id = ?", unsaved_show_ids)
+    played_ids = []
+    new_rows = []
+    for show_id, episodes in new_episodes.items():
+        for episode in episodes:
+            if episode.get('resume_point', {}).get('fully_played', False):
+                played_ids.append((episode['id'],))
+                continue
+            if _BLOCK_RE.search(episode['name']): continue
+            new_rows.append((
+                episode['id'], show_id, episode['uri'], episode['name'],
+                episode['duration_ms'], episode['release_date'],
+            ))
+            fresh_ids.add(episode['id'])
+    db.executemany("DELETE FROM episodes WHERE id = ?", played_ids)
+    db.executemany("INSERT OR REPLACE INTO episodes VALUES (?, ?, ?, ?, ?, ?)", new_rows)
+    db.executemany(
+        "INSERT OR REPLACE INTO show_progress VALUES (?, ?)",
+        [(show_id, episodes[0]['id']) for show_id, episodes in new_episodes.items() if episodes]
+    )
+    rows = db.execute(
+        "SELECT id, uri, name, duration_ms, release_date FROM episodes WHERE substr(release_date, 1, 10) > ?",
+        (last_update_dt.strftime('%Y-%m-%d'),)
+    )
+    priority_episodes = [dict(row) for row in rows]
+    return priority_episodes, fresh_ids
+def _load_backlog_by_minute(db, last_update_dt):
+    """Groups cached episodes released up to the last update by their length in minutes."""
     backlog_by_minute = defaultdict(list)
-    for ep in filtered_backlog:
-        minute = ep['duration_ms'] // 60000
-        backlog_by_minute[minute].append(ep)
-    sorted_minutes = sorted(backlog_by_minute.keys())
-    next_minute_to_add = -1
-    for minute in sorted_minutes:
-        if minute > last_minute_processed:
-            next_minute_to_add = minute
-            break
-    if next_minute_to_add == -1 and sorted_minutes:
-        next_minute_to_add = sorted_minutes[0]
-    return backlog_by_minute.get(next_minute_to_add, []), next_minute_to_add
+    rows = db.execute(
+        "SELECT id, uri, name, duration_ms, release_date FROM episodes WHERE substr(release_date, 1, 10) <= ?",
+        (last_update_dt.strftime('%Y-%m-%d'),)
+    )
+    for row in rows:
+        backlog_by_minute[row['duration_ms'] // 60000].append(dict(row))
+    return backlog_by_minute
+def _determine_next_backlog_batch(backlog_by_minute, last_minute_processed, min_duration=0):
+    """Filters backlog minutes by min_duration and finds the next batch to add."""
+    sorted_minutes = sorted(minute for minute in backlog_by_minute if minute >= min_duration)
+    if not sorted_minutes: return [], -1
+    i = bisect_right(sorted_minutes, last_minute_processed)
+    next_minute_to_add = sorted_minutes[i] if i < len(sorted_minutes) else sorted_minutes[0]
+    return backlog_by_minute[next_minute_to_add], next_minute_to_add
 def _update_job_status(user_id, message, progress, total, is_done=False, is_error=False):
-    background_jobs[user_id] = {
+    job = {
         "message": message, "progress": progress, "total": total,
         "is_done": is_done, "is_error": is_error,
     }
+    if redis_client:
+        redis_client.set(f"job:{user_id}", json.dumps(job), ex=JOB_STATUS_TTL)
+        redis_client.publish(f"job:{user_id}", json.dumps(job))
+    else:
+        with job_status_changed:
+            background_jobs[user_id] = job
+            job_status_changed.notify_all()
+def _get_job_status(user_id):
+    if redis_client:
+        job = redis_client.get(f"job:{user_id}")
+        return json.loads(job) if job else None
+    return background_jobs.get(user_id)
+def _clear_job_status(user_id):
+    if redis_client:
+        redis_client.delete(f"job:{user_id}")
+    else:
+        background_jobs.pop(user_id, None)
+def _wait_for_job_change(user_id, last_job, pubsub, timeout):
+    """Blocks until the user's job status changes or the timeout passes; returns whether it changed."""
+    if pubsub:
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0: return False
+            if pubsub.get_message(timeout=remaining) is not None: return True
+    with job_status_changed:
+        return job_status_changed.wait_for(lambda: background_jobs.get(user_id) != last_job, timeout=timeout)
+def _job_status_events(user_id):
+    """Yields a server-sent event each time the user's job status changes.
+
+    The stream ends when the job finishes, after STATUS_STREAM_TIMEOUT without a change, or after
+    STATUS_STREAM_MAX_AGE, so it never holds a worker for a whole scan; the browser reconnects.
+    """
+    pubsub = None
+    if redis_client:
+        pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(f"job:{user_id}")
+    try:
+        deadline = time.monotonic() + STATUS_STREAM_MAX_AGE
+        last_job = None
+        yield f"retry: {STATUS_STREAM_RETRY_MS}\n\n"
+        while True:
+            job = _get_job_status(user_id)
+            if job != last_job or last_job is None:
+                last_job = job
+                yield f"data: {json.dumps(job or {'status': 'idle'})}\n\n"
+            if not job or job.get('is_done') or job.get('is_error'):
+                if job: _clear_job_status(user_id)
+                return
+            timeout = min(STATUS_STREAM_TIMEOUT, deadline - time.monotonic())
+            if timeout <= 0 or not _wait_for_job_change(user_id, last_job, pubsub, timeout): return
+    finally:
+        if pubsub: pubsub.close()
 @app.route('/')
 def index():
     if not session.get(TOKEN_INFO_KEY):
@@ -174,7 +441,7 @@ def index():
     session['user_id'] = user_info['id']
     user_id = user_info['id']
     state = _load_state(user_id)
-    return render_template('index.html', user=user_info, state=state, is_running=(user_id in background_jobs))
+    return render_template('index.html', user=user_info, state=state, is_running=(_get_job_status(user_id) is not None), use_status_stream=ENABLE_STATUS_STREAM)
 @app.route('/login')
 def login():
     cache_path = os.path.join(STATE_FOLDER, f"cache-{uuid.uuid4()}")
@@ -192,7 +459,7 @@ def callback():
         redirect_uri=REDIRECT_URI, scope=SCOPE, cache_path=cache_path
     )
     token_info = auth_manager.get_access_token(request.args.get('code'), as_dict=True)
-    user_id = spotipy.Spotify(auth=token_info['access_token']).current_user()['id']
+    user_id = RetryingSpotify(auth=token_info['access_token'], requests_session=http_session).current_user()['id']
     session['user_id'] = user_id
     session[TOKEN_INFO_KEY] = token_info
     _save_token(user_id, token_info)
@@ -202,6 +469,7 @@ def callback():
 def logout():
     user_id = session.get('user_id')
     if user_id:
+        _AUTH_MANAGERS.pop(user_id, None)
         token_path = _get_token_path(user_id)
         if os.path.exists(token_path):
             os.remove(token_path)
@@ -210,19 +478,22 @@ def logout():
 @app.route('/start-update', methods=['POST'])
 def start_update():
     user_id = session.get('user_id')
-    if not user_id or user_id in background_jobs: return redirect('/')
+    if not user_id or _get_job_status(user_id): return redirect('/')
     state = _load_state(user_id)
     playlist_id = state.get('playlist_id')
     if not playlist_id: return "Error: Playlist ID not set.", 400
     _update_job_status(user_id, "Starting update...", 0, 0)
-    thread = threading.Thread(target=run_update_task, args=(user_id, playlist_id))
-    thread.daemon = True
-    thread.start()
+    if task_queue:
+        task_queue.enqueue(run_update_task, user_id, playlist_id, job_timeout=JOB_TIMEOUT)
+    else:
+        thread = threading.Thread(target=run_update_task, args=(user_id, playlist_id))
+        thread.daemon = True
+        thread.start()
     return redirect('/')
 @app.route('/create-playlist-and-scan', methods=['POST'])
 def create_playlist_and_scan():
     user_id = session.get('user_id')
-    if not user_id or user_id in background_jobs: return redirect('/')
+    if not user_id or _get_job_status(user_id): return redirect('/')
     sp = get_spotify_client()
     user_info = sp.current_user()
     playlist = sp.user_playlist_create(
@@ -262,8 +533,17 @@ def save_settings():
 def status():
     user_id = session.get('user_id')
     if not user_id: return jsonify({"error": "Not logged in"}), 401
-    job = background_jobs.get(user_id)
+    job = _get_job_status(user_id)
     if not job: return jsonify({"status": "idle"})
     if job.get('is_done') or job.get('is_error'):
-        background_jobs.pop(user_id, None)
-    return jsonify(job)
\ No newline at end of file
+        _clear_job_status(user_id)
+    return jsonify(job)
+@app.route('/status/stream')
+def status_stream():
+    """Yields a server-sent event per job status change, ending when the job finishes or the stream times out."""
+    user_id = session.get('user_id')
+    if not user_id: return jsonify({"error": "Not logged in"}), 401
+    return Response(
+        _job_status_events(user_id), mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
\ No newline at end of file